@@ -1,9 +1,54 @@
+import gzip
+import logging
+import os
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
 
+try:
+    from numba import njit
+except ImportError:
+    # Numba is optional. Without it the round kernel below runs as plain
+    # Python, which gives the same answers but is much slower on the big
+    # contests.
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda func: func
 
-def parse_master_lookup(master_lookup_filename):
+
+logger = logging.getLogger(__name__)
+
+
+def _read_cached_frame(source_filename):
+    """Read a cached parse of `source_filename`, or None if there isn't one.
+
+    The cache is a feather file next to the source. A cache older than its
+    source is ignored, as is any cache that can't be read (missing pyarrow,
+    stale format, etc) -- caching is strictly best-effort.
+    """
+    cache_filename = source_filename + '.feather'
+    try:
+        if (os.path.exists(cache_filename) and
+                os.path.getmtime(cache_filename) >=
+                os.path.getmtime(source_filename)):
+            return pd.read_feather(cache_filename)
+    except Exception:
+        pass
+    return None
+
+
+def _write_cached_frame(df, source_filename):
+    """Write `df` as a feather cache next to `source_filename`, if possible."""
+    try:
+        df.to_feather(source_filename + '.feather')
+    except Exception:
+        pass
+
+
+def parse_master_lookup(master_lookup_filename, use_cache=True):
     """Parse the master lookup file, according to the 2018 format.
 
     The master lookup file provides a mapping from every record type (precinct,
@@ -13,8 +58,14 @@ def parse_master_lookup(master_lookup_filename):
     Args:
         master_lookup_filename: A path to the master lookup file, from SF
             department of elections.
+        use_cache: If True, keep a feather cache of the parsed dataframe
+            next to the source file and reuse it on later runs.
     Returns a pandas dataframe with the master lookup information.
     """
+    if use_cache:
+        cached = _read_cached_frame(master_lookup_filename)
+        if cached is not None:
+            return cached
     # The master lookup file has the following fixed-column-width format:
     # Field                 startcol stopcol fieldlen
     # Record_Type           1        10      10
@@ -40,10 +91,58 @@ def parse_master_lookup(master_lookup_filename):
     ]
     widths = [10, 7, 50, 7, 7, 1, 1]
     lookup = pd.read_fwf(master_lookup_filename, widths=widths, names=names)
+    if use_cache:
+        _write_cached_frame(lookup, master_lookup_filename)
     return lookup
 
 
-def parse_ballot_image(ballot_image_filename):
+def _parse_fixed_width_numeric(raw, widths):
+    """Parse fixed-width lines of whitespace-padded integers with numpy.
+
+    `raw` is the whole file as bytes. Every line must have the same length
+    and every field must be numeric (this holds for the ballot image format,
+    but not the master lookup, which has text fields). Returns one int64
+    array per field.
+
+    This is much faster than `pd.read_fwf`, which tokenizes each field
+    through Python string handling; here each field is a byte-column slice
+    parsed with a few vectorized ops per character position.
+
+    Raises ValueError if the lines aren't actually fixed-width.
+    """
+    line_len = raw.find(b'\n') + 1
+    if line_len == 0:
+        raise ValueError("no newline found")
+    if len(raw) % line_len == line_len - 1:
+        # Missing trailing newline on the last line
+        raw = raw + b'\n'
+    if len(raw) % line_len != 0:
+        raise ValueError("ragged lines")
+    lines = np.frombuffer(raw, dtype=np.uint8).reshape(-1, line_len)
+    # Tolerate \r\n line endings
+    data_len = line_len - (2 if lines[0, line_len - 2] == ord('\r') else 1)
+    if sum(widths) != data_len:
+        raise ValueError(
+            "line length %d doesn't match field widths" % data_len)
+
+    fields = []
+    start = 0
+    for width in widths:
+        block = lines[:, start:start + width]
+        start += width
+        values = np.zeros(len(block), dtype=np.int64)
+        # A handful of character positions per field; each one is a
+        # vectorized pass. Padding spaces multiply by 1 and add 0, so only
+        # digit positions contribute.
+        for char in block.T:
+            is_digit = (char >= ord('0')) & (char <= ord('9'))
+            values *= np.where(is_digit, 10, 1)
+            values += np.where(is_digit, char - ord('0'), 0)
+        fields.append(values)
+    return fields
+
+
+def parse_ballot_image(ballot_image_filename, use_cache=True):
     """Parse the "ballot image" file, according to the 2018 format.
 
     The ballot image file contains all votes cast in all races for a given
@@ -54,8 +153,15 @@ def parse_ballot_image(ballot_image_filename):
     Args:
         ballot_image_filename: A path to the ballot image file, from SF
             department of elections.
+        use_cache: If True, keep a feather cache of the parsed dataframe
+            next to the source file and reuse it on later runs. Reading
+            the cache skips both gzip decompression and parsing.
     Returns a pandas dataframe with the ballot image data.
     """
+    if use_cache:
+        cached = _read_cached_frame(ballot_image_filename)
+        if cached is not None:
+            return cached
     # https://sfelections.org/results/20180605/data/BallotImageRCVhelp.pdf
     # https://sfelections.org/results/20180605/data/20180627/20180627_ballotimage.txt
 
@@ -81,18 +187,79 @@ def parse_ballot_image(ballot_image_filename):
         'Under_Vote'
     ]
     widths = [7, 9, 7, 3, 7, 3, 7, 1, 1]
-    kwargs = {}
-    if ballot_image_filename.endswith('.gz'):
-        kwargs = {'compression': 'gzip'}
-    votes = pd.read_fwf(
-        ballot_image_filename, widths=widths, names=names, **kwargs)
+    # Every field is a small integer, so parse straight into narrow dtypes.
+    # This shrinks the frame to a fraction of the default int64 size, which
+    # makes the grouping and filtering downstream noticeably faster.
+    dtypes = {
+        'Contest_Id': np.int32,
+        'Pref_Voter_Id': np.int32,
+        'Serial_Number': np.int32,
+        'Tally_Type_Id': np.int8,
+        'Precinct_Id': np.int32,
+        'Vote_Rank': np.int8,
+        'Candidate_Id': np.int32,
+        'Over_Vote': np.int8,
+        'Under_Vote': np.int8,
+    }
+    is_gzipped = ballot_image_filename.endswith('.gz')
+    try:
+        if is_gzipped:
+            with gzip.open(ballot_image_filename, 'rb') as f:
+                raw = f.read()
+        else:
+            with open(ballot_image_filename, 'rb') as f:
+                raw = f.read()
+        fields = _parse_fixed_width_numeric(raw, widths)
+        votes = pd.DataFrame(
+            dict((name, field.astype(dtypes[name]))
+                 for name, field in zip(names, fields)),
+            columns=names)
+    except ValueError:
+        # Not actually fixed-width; let pandas figure it out.
+        kwargs = {}
+        if is_gzipped:
+            kwargs = {'compression': 'gzip'}
+        votes = pd.read_fwf(
+            ballot_image_filename, widths=widths, names=names, dtype=dtypes,
+            **kwargs)
+    if use_cache:
+        _write_cached_frame(votes, ballot_image_filename)
     return votes
 
 
-def get_votes_for_contest(contest_name, master_lookup_df, ballot_image_df):
-    contest_id = master_lookup_df[
-        (master_lookup_df['Record_Type'] == 'Contest') &
-        (master_lookup_df['Description'] == contest_name)]['Id'].values[0]
+def build_contest_index(master_lookup_df):
+    """Build a dict mapping contest name to contest id.
+
+    Compute this once and pass it to `get_votes_for_contest` to avoid
+    re-scanning the master lookup for every contest.
+    """
+    contests = master_lookup_df[master_lookup_df['Record_Type'] == 'Contest']
+    return dict(zip(contests['Description'], contests['Id']))
+
+
+def index_ballots_by_contest(ballot_image_df):
+    """Split the ballot image into a dict of contest id to votes.
+
+    Compute this once and pass it to `get_votes_for_contest` to avoid
+    re-filtering the whole ballot image for every contest.
+    """
+    return dict(list(ballot_image_df.groupby('Contest_Id', sort=False)))
+
+
+def get_votes_for_contest(contest_name, master_lookup_df, ballot_image_df,
+                          contest_index=None, ballots_by_contest=None):
+    """Get the votes for a single contest, by name.
+
+    `contest_index` and `ballots_by_contest` are the (optional) precomputed
+    structures from `build_contest_index` and `index_ballots_by_contest`;
+    with both supplied this is a pair of dict lookups instead of two full
+    table scans.
+    """
+    if contest_index is None:
+        contest_index = build_contest_index(master_lookup_df)
+    contest_id = contest_index[contest_name]
+    if ballots_by_contest is not None:
+        return ballots_by_contest[contest_id]
     return ballot_image_df[ballot_image_df['Contest_Id'] == contest_id]
 
 
@@ -106,22 +273,71 @@ def get_supervisor_votes(district, master_lookup_df, ballot_image_df):
         contest_name, master_lookup_df, ballot_image_df)
 
 
+@njit(cache=True)
+def _rcv_advance(voter_id, cand_id, over, under, eliminated, rows, tallies):
+    """Advance each ballot in `rows` to its next countable choice.
+
+    The vote arrays must be sorted by (voter, rank) so each voter's rows
+    form a contiguous block. For each starting row, walk forward through
+    that voter's block past undervotes and eliminated candidates; an
+    overvote exhausts the ballot, a live candidate gets the ballot. Each
+    resettled ballot's candidate is added to `tallies` in place.
+
+    Ballots only ever move forward: the first round starts every ballot at
+    its block start, and later rounds pass only the rows whose candidate
+    was just eliminated. That keeps each round's work proportional to the
+    votes being redistributed, not the whole contest, and means every
+    undervote and overvote is reported in exactly one round.
+
+    Returns (settled_rows, num_undervotes, num_overvotes); ballots that hit
+    an overvote or run out of choices drop out of settled_rows.
+    """
+    n = len(voter_id)
+    settled = np.empty(len(rows), dtype=np.int64)
+    num_settled = 0
+    num_undervotes = 0
+    num_overvotes = 0
+    for r in range(len(rows)):
+        j = rows[r]
+        voter = voter_id[j]
+        while j < n and voter_id[j] == voter:
+            if under[j] == 1:
+                num_undervotes += 1
+                j += 1
+            elif eliminated[cand_id[j]]:
+                j += 1
+            elif over[j] == 1:
+                num_overvotes += 1
+                break
+            else:
+                tallies[cand_id[j]] += 1
+                settled[num_settled] = j
+                num_settled += 1
+                break
+        # Falling out of the block means the ballot ran out of choices.
+    return settled[:num_settled], num_undervotes, num_overvotes
+
+
+# A compact per-round summary: `tallies` is a Series of vote counts indexed
+# by candidate id (None for the bookkeeping rounds before counting starts).
 RcvRound = namedtuple(
     "RcvRound",
-    ["name", "votes", "num_undervotes", "num_overvotes", "dropped_candidate"])
+    ["name", "tallies", "num_undervotes", "num_overvotes",
+     "dropped_candidate"])
 
 
 def run_rcv_for_contest(
         contest_name, master_lookup_df, ballot_image_df, threshold=0.5):
     """Run RCV elimination for a given contest.
 
-    Returns a tuple of a list of dataframes with the votes redistributed. The
-    0th dataframe is all votes (1st dataframe is after the first round, etc),
-    and the winner candidate id.
+    Returns a tuple of a list of RcvRound summaries, one per elimination
+    round (the first two are bookkeeping rounds: the original data and the
+    all-undervote drop), and the winner candidate id.
     """
+    # No defensive copy needed: the round kernel works on int arrays
+    # extracted below and this function never mutates the DataFrame.
     votes = get_votes_for_contest(
         contest_name, master_lookup_df, ballot_image_df)
-    votes = votes.copy(deep=True)
     # Rules:
     # 1. Eliminate last place and redistribute votes until one candidate has
     #    > threshold votes.
@@ -138,7 +354,6 @@ def run_rcv_for_contest(
     # 6. When the next choice is the same candidate (eg Alice #1, Alice #2,
     #    Alice #3), skip them as in #5.
 
-    exhausted = set()
     # The data looks like this:
     # Id      Contest_Id  Pref_Voter_Id   Precinct_Id Vote_Rank   Candidate_Id    Over_Vote   Under_Vote
     # 762048  21          13525           281         1           188             0           0
@@ -152,108 +367,163 @@ def run_rcv_for_contest(
     winner = None
 
     # The zeroth round is the input data
-    rounds = [RcvRound("Original", votes, 0, 0, None)]
-    # First remove all completely undervoted ballots. That's people who didn't
-    # vote for anyone at all.
-    _is_all_undervote = votes.groupby('Pref_Voter_Id')['Under_Vote'].all()
-    all_undervote_voter_ids = _is_all_undervote[_is_all_undervote].index
-    votes = votes[~votes.Pref_Voter_Id.isin(all_undervote_voter_ids)]
+    rounds = [RcvRound("Original", None, 0, 0, None)]
+
+    # The elimination loop only ever touches a handful of integer columns, so
+    # pull those out of the DataFrame once into parallel contiguous int32
+    # arrays (a struct-of-arrays layout) and do all the per-round work with
+    # numpy. This avoids rebuilding pandas indexes every round and touches
+    # far fewer bytes per pass over the ballots.
+    def _as_int32(column):
+        return np.ascontiguousarray(votes[column].values, dtype=np.int32)
+
+    voter_id = _as_int32('Pref_Voter_Id')
+    vote_rank = _as_int32('Vote_Rank')
+    cand_id = _as_int32('Candidate_Id')
+    over = _as_int32('Over_Vote')
+    under = _as_int32('Under_Vote')
+    # Sort everything by (voter, rank) so each voter's rows form a contiguous
+    # block with their top remaining choice first. The round kernel relies
+    # on this ordering, and we only sort once. Packing both keys into one
+    # uint64 (voter in the high bits, rank in the low bits — both are
+    # non-negative and fit in 32 bits) makes this a single-array argsort
+    # instead of a two-key lexsort.
+    sort_key = ((voter_id.astype(np.uint64) << np.uint64(32)) |
+                vote_rank.astype(np.uint64))
+    order = np.argsort(sort_key, kind='stable')
+    voter_id = voter_id[order]
+    vote_rank = vote_rank[order]
+    cand_id = cand_id[order]
+    over = over[order]
+    under = under[order]
+
+    # First remove all completely undervoted ballots. That's people who
+    # didn't vote for anyone at all. Each voter is one contiguous block of
+    # the sorted arrays, so a ballot is all-undervote exactly when the
+    # minimum of Under_Vote over its block is 1.
+    starts = np.nonzero(
+        np.r_[True, voter_id[1:] != voter_id[:-1]])[0]
+    is_all_undervote = np.minimum.reduceat(under, starts) == 1
+    num_all_undervote = int(np.count_nonzero(is_all_undervote))
+    block_lengths = np.diff(np.append(starts, len(voter_id)))
+    keep = ~np.repeat(is_all_undervote, block_lengths)
+    voter_id = voter_id[keep]
+    vote_rank = vote_rank[keep]
+    cand_id = cand_id[keep]
+    over = over[keep]
+    under = under[keep]
     # The first round is all-undervotes dropped
-    rounds.append(
-        RcvRound("Round 0", votes, len(all_undervote_voter_ids), 0, None))
+    rounds.append(RcvRound("Round 0", None, num_all_undervote, 0, None))
+
+    # Elimination is a bool mask indexed by candidate id; the vote arrays
+    # themselves never change. Tallies are maintained incrementally: the
+    # first round walks every ballot forward to its first countable choice,
+    # and each later round re-walks only the ballots freed up by that
+    # round's elimination, so per-round work is proportional to the votes
+    # being redistributed rather than the whole contest.
+    eliminated_mask = np.zeros(int(cand_id.max()) + 1, dtype=np.bool_)
+    tallies = np.zeros(len(eliminated_mask), dtype=np.int64)
+    # Every ballot starts its walk at its block's first row.
+    to_walk = np.nonzero(np.r_[True, voter_id[1:] != voter_id[:-1]])[0]
+    top_rows = np.empty(0, dtype=np.int64)
 
     # Start the ranking
     while not winner:
-        print("Round %d" % (len(rounds) - 1))
-        keep_going = True
-        num_undervotes = 0
-        num_overvotes = 0
+        logger.info("Round %d", len(rounds) - 1)
+        settled, num_undervotes, num_overvotes = _rcv_advance(
+            voter_id, cand_id, over, under, eliminated_mask, to_walk,
+            tallies)
+        # Re-sorting keeps top_rows ordered by voter id.
+        top_rows = np.sort(np.concatenate((top_rows, settled)))
+        if num_undervotes > 0:
+            logger.debug("%d undervotes", num_undervotes)
+        if num_overvotes > 0:
+            logger.debug("%d overvotes", num_overvotes)
+
+        candidates = np.nonzero(tallies)[0]
+        # Fancy indexing copies, so the recorded Series is immune to the
+        # tallies updates in later rounds.
+        round_tallies = pd.Series(tallies[candidates], index=candidates)
+
         eliminated = None
-        while keep_going:
-            keep_going = False
-            # Look at the highest rank vote for each voter.
-            top_votes = \
-                votes.sort_values('Vote_Rank').groupby('Pref_Voter_Id').first()
-
-            # If the top choice is an undervote, drop it and keep going
-            undervotes = top_votes[top_votes['Under_Vote'] == 1]
-            if len(undervotes) > 0:
-                num_undervotes += len(undervotes)
-                print("%d undervotes" % len(undervotes))
-                keep_going = True
-                # ##### Slowest method #####
-                # ir = undervotes.iterrows()
-                # row = ir.next()
-                # x = votes[(votes.Pref_Voter_Id == row[0]) &
-                #           (votes.Vote_Rank == row[1].Vote_Rank)]
-                # for row in ir:
-                #     x = x | votes[(votes.Pref_Voter_Id == row[0]) &
-                #                   (votes.Vote_Rank == row[1].Vote_Rank)]
-                # votes = votes.drop(x.index, axis=0)
-
-                # Fast method of the above
-                idxs = [(row[0], row[1].Vote_Rank)
-                        for row in undervotes.iterrows()]
-                drop_idxs = votes.reset_index().set_index(
-                    ["Pref_Voter_Id", "Vote_Rank"]).loc[idxs]["index"].values
-                votes = votes.drop(drop_idxs, axis=0)
-
-            overvotes = top_votes[top_votes['Over_Vote'] == 1]
-            if len(overvotes) > 0:
-                num_overvotes += len(overvotes)
-                print("%d overvotes" % len(overvotes))
-                keep_going = True
-                # Mark all these voters as exhausted
-                # Note that overvotes' index is Pref_Voter_Id
-                exhausted |= set(overvotes.index)
-                # And remove those voters from the set of votes
-                votes = votes[~votes['Pref_Voter_Id'].isin(exhausted)]
-
-        # And count those votes by candidate
-        candidate_votes = \
-            top_votes.groupby('Candidate_Id').count().sort_values('Vote_Rank')
-
-        total_votes = candidate_votes.sum()['Vote_Rank']
-        top_vote_count = candidate_votes.iloc[
-            len(candidate_votes) - 1]['Vote_Rank']
-        if top_vote_count * 1.0 / total_votes > threshold:
-            winner = candidate_votes.index[len(candidate_votes) - 1]
+        total_votes = int(tallies.sum())
+        top_candidate = candidates[np.argmax(tallies[candidates])]
+        if tallies[top_candidate] * 1.0 / total_votes > threshold:
+            winner = int(top_candidate)
         else:
             # eliminate last place and redistribute
-            eliminated = candidate_votes.index[0]
-            votes = votes[votes['Candidate_Id'] != eliminated]
+            eliminated = int(candidates[np.argmin(tallies[candidates])])
+            eliminated_mask[eliminated] = True
+            tallies[eliminated] = 0
+            affected = cand_id[top_rows] == eliminated
+            to_walk = top_rows[affected]
+            top_rows = top_rows[~affected]
         rounds.append(
-            RcvRound("Round %d" % (len(rounds) - 1), top_votes, num_undervotes,
-                     num_overvotes, eliminated))
+            RcvRound("Round %d" % (len(rounds) - 1), round_tallies,
+                     num_undervotes, num_overvotes, eliminated))
     return rounds, winner
 
 
+def run_all_rcv_contests(master_lookup_df, ballot_image_df, threshold=0.5,
+                         max_workers=None):
+    """Run RCV elimination for every contest in the ballot image.
+
+    Contests are independent, so each runs in its own worker process. Only
+    the contest's own ballots are shipped to each worker.
+
+    Returns a dict mapping contest name to the (rounds, winner) tuple from
+    `run_rcv_for_contest`.
+    """
+    contest_index = build_contest_index(master_lookup_df)
+    ballots_by_contest = index_ballots_by_contest(ballot_image_df)
+    contest_names = sorted(
+        name for name, cid in contest_index.items()
+        if cid in ballots_by_contest)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict(
+            (name, executor.submit(
+                run_rcv_for_contest, name, master_lookup_df,
+                ballots_by_contest[contest_index[name]], threshold))
+            for name in contest_names)
+        return dict(
+            (name, future.result()) for name, future in futures.items())
+
+
 def pretty_print_rcv_rounds(contest_name, master_lookup_df, rcv_rounds):
-    contest_id = master_lookup_df[
-        (master_lookup_df['Record_Type'] == 'Contest') &
-        (master_lookup_df['Description'] == contest_name)]['Id'].values[0]
+    # Join candidates to their contest in one pass over the master lookup,
+    # rather than scanning the whole frame once for the contest id and again
+    # for its candidates.
+    record_type = master_lookup_df['Record_Type']
+    candidates = master_lookup_df[record_type == 'Candidate']
+    contests = master_lookup_df[record_type == 'Contest']
+    merged = candidates.merge(
+        contests[['Id', 'Description']], left_on='Candidates_Contest_Id',
+        right_on='Id', suffixes=('', '_contest'))
     id_to_candidate_name = dict(
-        master_lookup_df[
-            master_lookup_df['Candidates_Contest_Id'] == contest_id][
-                ['Id', 'Description']].values)
+        merged[merged['Description_contest'] == contest_name][
+            ['Id', 'Description']].values)
 
-    last_votes = {}
+    last_counts = None
     for rnd in rcv_rounds[0][2:]:
         print(rnd.name)
-        id_to_vote_counts = dict(
-            rnd.votes.groupby('Candidate_Id')['Contest_Id'].count())
-        if not last_votes:
-            last_votes = id_to_vote_counts
-        total = sum(id_to_vote_counts.values())
-        for (vid, cnts) in sorted(id_to_vote_counts.iteritems()):
-            last_vote = last_votes.get(vid, 0)
-            last_vote_display = ""
-            if last_vote != cnts:
-                last_vote_display = "+%d" % (cnts - last_vote)
+        counts = rnd.tallies
+        if last_counts is None:
+            last_counts = counts
+        # Compute the gained-votes column and percentages for the whole
+        # round at once; the loop below only does the printing. Display
+        # order is one np.sort over the int candidate ids, not a generic
+        # index sort.
+        total = counts.sum()
+        gained = counts - last_counts.reindex(counts.index, fill_value=0)
+        percents = counts * 100.0 / total
+        for vid in np.sort(counts.index.values):
+            gained_display = ""
+            if gained[vid] != 0:
+                gained_display = "+%d" % gained[vid]
             print("%30s %7d %6s %5.2f%%" %
                   (id_to_candidate_name[vid],
-                      cnts,
-                      last_vote_display,
-                      cnts * 100.0 / total))
-            last_votes[vid] = cnts
-        print
+                      counts[vid],
+                      gained_display,
+                      percents[vid]))
+        last_counts = counts
+        print("")